@@ -0,0 +1,186 @@
+"""
+Hedged genmove: send the same genmove to several engines at once and pick an answer according to a policy.
+
+Every engine runs behind its own EngineWatchdog (and so its own HTPController), and gets its commands from its own worker
+thread, so a slow engine never blocks the others. Engines whose answer was not picked are brought back in sync by replaying
+the kifu and the chosen move once they are done thinking.
+"""
+from queue import Queue, Empty
+import logging
+import time
+
+from htpclient.htp_controller import RED, BLUE
+from htpclient.watchdog import EngineError, EngineWorker, replay
+
+logging = logging.getLogger(__name__)
+
+FIRST = "first"  # Take the first valid answer.
+VOTE = "vote"  # Take the move most engines agree on within the vote timeout.
+POLICIES = (FIRST, VOTE)
+
+DEFAULT_VOTE_TIMEOUT = 5
+
+
+class HedgedEngine(object):
+    """
+    Exposes the same commands as EngineWatchdog, but over several engines.
+
+    command_play and command_clearboard are sent to all engines, genmove is sent to all engines and answered according to
+    the policy.
+    """
+
+    def __init__(self, engines, policy=FIRST, vote_timeout=DEFAULT_VOTE_TIMEOUT):
+        """
+        :param engines: list of EngineWatchdog objects to hedge over.
+        :param policy: FIRST or VOTE.
+        :param vote_timeout: time in seconds to wait for votes with the VOTE policy.
+        """
+        if policy not in POLICIES:
+            raise ValueError("Invalid hedging policy: {}".format(repr(policy)))
+        if not engines:
+            raise ValueError("HedgedEngine needs at least one engine.")
+
+        self.policy = policy
+        self.vote_timeout = vote_timeout
+        self._members = [_Member(engine, idx) for idx, engine in enumerate(engines)]
+
+    def command_clearboard(self):
+        """ Tell all engines to clear the board. """
+        for member in self._members:
+            member.put(member.engine.command_clearboard)
+
+    def command_play(self, color, coordinates):
+        """ Tell all engines to make given move internally. """
+        for member in self._members:
+            member.put(member.engine.command_play, color, coordinates)
+
+    def command_quit(self):
+        """ Tell all engines to quit. Sent directly, as engines might still be thinking. """
+        for member in self._members:
+            member.engine.command_quit()
+
+    def genmove(self, color, kifu=()):
+        """
+        Send genmove to all engines, and return a move according to the policy.
+
+        :param color: color to generate a move for.
+        :param kifu: HTP moves played so far in the game, starting with blue. Used to resync engines that were not picked.
+        :return: HTP-compliant move.
+        """
+        kifu = list(kifu)
+        answers = Queue()  # A new queue for every request, so late answers from older requests are never mixed in.
+        for member in self._members:
+            member.put(member.genmove, color, kifu, answers)
+
+        if self.policy == FIRST:
+            move = self._first(answers)
+        else:
+            move = self._vote(answers)
+
+        logging.info("Hedged genmove for {} picked {}.".format(repr(color), repr(move)))
+        for member in self._members:
+            member.put(member.sync, color, kifu, move)
+        return move
+
+    def _first(self, answers):
+        """ Return the first valid answer. """
+        for _ in self._members:
+            idx, move = answers.get()
+            if move is not None:
+                logging.debug("Engine #{} answered first: {}".format(idx, repr(move)))
+                return move
+        raise EngineError("None of the hedged engines answered genmove.")
+
+    def _vote(self, answers):
+        """ Collect answers until all engines answered or the vote timeout expired, and return the most common move. """
+        votes = []  # Kept in order of arrival, so ties are broken in favor of the faster engines.
+        deadline = time.time() + self.vote_timeout
+        received = 0
+
+        while received < len(self._members):
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                if votes:
+                    break
+                timeout = None  # Nobody answered in time, fall back to waiting for the first valid answer.
+            try:
+                idx, move = answers.get(timeout=timeout)
+            except Empty:
+                continue
+            received += 1
+            if move is not None:
+                votes.append(move)
+
+        if not votes:
+            raise EngineError("None of the hedged engines answered genmove.")
+
+        move = max(votes, key=lambda m: (votes.count(m), -votes.index(m)))
+        logging.debug("Votes: {}, picked {}".format(votes, repr(move)))
+        return move
+
+
+class _Member(EngineWorker):
+    """ One hedged engine, and the worker thread that sends it its commands in order. """
+
+    def __init__(self, engine, idx):
+        super().__init__(engine, idx, "hedge-worker-{}".format(idx))
+        self.last_move = None
+
+    def genmove(self, color, kifu, answers):
+        try:
+            self.last_move = self.engine.genmove(color, kifu)
+        except EngineError as err:
+            logging.error("Hedged engine #{} failed: {}".format(self.idx, repr(err)))
+            self.last_move = None
+        answers.put((self.idx, self.last_move))
+
+    def sync(self, color, kifu, move):
+        """ If this engine played something other than move, replay the position with move on top of it. """
+        if self.last_move == move:
+            return
+
+        logging.info("Resyncing hedged engine #{} (played {}, picked {}).".format(self.idx, repr(self.last_move), repr(move)))
+        replay(self.engine, kifu)
+        self.engine.command_play(color, move)
+
+
+if __name__ == "__main__":
+    import os
+    import shlex
+    import sys
+    import tempfile
+
+    from htpclient.watchdog import EngineWatchdog
+
+    os.chdir(tempfile.mkdtemp())  # The test engine logs to logs/engine.log.
+    os.makedirs("logs")
+    test_engine = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_engine.py")
+
+    def engine_command(*lines):
+        path = "moves{}.txt".format(len(os.listdir(".")))
+        with open(path, "wt") as f:
+            f.write("".join(line + "\n" for line in lines))
+        return " ".join(shlex.quote(word) for word in (sys.executable, test_engine, path))
+
+    def make_engines(*move_files):
+        return [EngineWatchdog(engine_command(*lines), genmove_timeout=1, standby=False) for lines in move_files]
+
+    # FIRST takes the fast answer. The engine that hung is replaced by one answering with the last move it was told to play,
+    # which is not the picked move. It is resynced, so its next "= last" shows the picked move on its board.
+    engines = make_engines(["hang"], ["= c3", "= e5"])
+    engines[0].command = engine_command("= last", "= last")
+    hedged = HedgedEngine(engines, policy=FIRST)
+    hedged.command_play(BLUE, "a1")
+    start = time.time()
+    assert hedged.genmove(RED, ["a1"]) == "c3"
+    assert time.time() - start < 1
+    hedged.policy, hedged.vote_timeout = VOTE, 5  # Wait for both answers this time.
+    hedged.genmove(BLUE, ["a1", "c3"])
+    assert hedged._members[0].last_move == "c3" and hedged._members[1].last_move == "e5"
+    hedged.command_quit()
+
+    # VOTE takes the majority.
+    hedged = HedgedEngine(make_engines(["= a1"], ["= b2"], ["= b2"]), policy=VOTE, vote_timeout=5)
+    assert hedged.genmove(BLUE) == "b2"
+    hedged.command_quit()
+    print("HedgedEngine tests passed")
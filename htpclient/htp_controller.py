@@ -1,10 +1,22 @@
 """
 The HTP class uses two pipes to manage communication between the client and the program. It accepts two pipes as arguments, pipe_in and pipe_out.
 HTP will send commands to the engine through pipe_out, and read the responses from pipe_in.
+
+Responses are framed as in GTP: a status line starting with "=" or "?" (optionally followed by an id), any number of payload
+lines, and an empty line. Only the empty line ends a response, so payload lines starting with "=" or "?" are kept. Engines that
+don't send the empty line are supported when a frame_timeout is given: their responses end when the next one starts or when the
+engine has been quiet for frame_timeout seconds. Without it, a response left open is reported once, as a likely missing empty line.
+
+Responses are matched with the oldest unanswered command, as they come back in order. With command_ids, every command is sent
+with a GTP id instead ("1 genmove B"), and responses are matched by the id the engine echoes, so a stray response can't take the
+place of another. Engines must then accept and echo the ids, which plain HTP engines don't, so it is opt-in.
+Only replies to the latest genmove (or reg_genmove) reach move_queue, replies to older ones are dropped as stale.
 """
 
-from queue import Queue
-from threading import Thread
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+import itertools
 import logging
 import time
 
@@ -16,6 +28,15 @@ BLUE = "B"
 FAIL_PREFIX = "?"
 SUCCESS_PREFIX = "="
 
+READ_SIZE = 65536  # Maximum number of bytes taken from the pipe at once.
+LENIENT_FRAME_TIMEOUT = 0.05  # Suggested frame_timeout for engines that don't end their responses with an empty line.
+UNTERMINATED_WARNING_DELAY = 2  # Seconds a response may stay open without a frame_timeout before we warn about it.
+
+RESPONSE_QUEUE_SIZE = 64  # Framed responses waiting for the parser. When full, the reader stops reading from the engine.
+RESULT_QUEUE_SIZE = 16  # Size of move_queue and fail_queue. When full, the oldest item is dropped.
+MAX_PENDING = 1024  # Unanswered commands we keep track of. Past that, we assume the oldest will never be answered.
+MOVE_COMMANDS = ("genmove", "reg_genmove")
+
 PASS = "pass"
 RESIGN = "resign"
 
@@ -25,25 +46,50 @@ class HTPController(object):
     The controller class for the protocol.
 
     Use HTPController.send, or one of the command functions, to send commands to pipe_out, and read moves from HTPController.move_queue
-    or errors from HTPController.fail_queue.
+    or errors (as Response objects) from HTPController.fail_queue.
+
+    Every genmove and clearboard starts a new generation and empties move_queue and fail_queue, so whatever is read from them
+    after sending a genmove belongs to it. dropped_stale, dropped_unsolicited and overflowed count the responses that were dropped.
     """
 
-    def __init__(self, pipe_in, pipe_out):
+    def __init__(self, pipe_in, pipe_out, response_callback=None, frame_timeout=None, command_ids=False):
         """
         Initialize an engine reading input from pipe_in and sending output to pipe_out.
 
-        This will start a daemon thread reading on std_in and placing responses in Engine.responses. No parsing is done to the responses.
+        This will start a daemon thread reading on std_in and framing the data into Response objects, and a daemon thread parsing them.
 
         :param pipe_in: filelike object to read data from. Usually a pipe. Will be read in a loop.
         :param pipe_out: filelike object to write data to. Usually a pipe.
+        :param response_callback: (default=None) called from the parser thread with every Response, e.g. for multi-line output.
+        :param frame_timeout: (default=None) seconds of silence after which an unterminated response is considered complete.
+                              Only for engines that don't end their responses with an empty line, as it cuts slow multi-line output.
+        :param command_ids: (default=False) send every command with a GTP id. Only for engines that accept and echo ids.
         """
         self._pipe_in = pipe_in
         self._pipe_out = pipe_out
+        self.response_callback = response_callback
+        self.frame_timeout = frame_timeout
+        self.command_ids = command_ids
+
+        self._response_queue = Queue(maxsize=RESPONSE_QUEUE_SIZE)
+        self._framer = ResponseFramer(lenient=frame_timeout is not None)
+        self._warned_unterminated = False
+        self._framer_lock = Lock()  # The framer is fed by the reader, and flushed by the parser when the engine goes quiet.
+
+        self.move_queue = Queue(maxsize=RESULT_QUEUE_SIZE)
+        self.fail_queue = Queue(maxsize=RESULT_QUEUE_SIZE)
 
-        self._response_queue = Queue()
+        self._pending = OrderedDict()  # Command id to (command name, generation) of the commands not answered yet, oldest first.
+        self._send_lock = Lock()  # Guards self._pending, the generation and the result queues.
+        self._ids = itertools.count(1)
+        self._echoes_ids = False  # Set once the engine answers with an id. From then on, responses without one are unsolicited.
+        self._generation = 0
 
-        self.move_queue = Queue()
-        self.fail_queue = Queue()
+        self.dropped_stale = 0  # Move replies to a genmove older than the latest one.
+        self.dropped_unsolicited = 0  # Responses that didn't match any command.
+        self.overflowed = 0  # Items dropped from full queues, and commands we gave up waiting for.
+
+        self.eof_event = Event()  # Set by the reader once pipe_in is closed, i.e. the engine is gone.
 
         reader_thread = Thread(target=self._reader, name="pipe-in-reader")
         reader_thread.daemon = True
@@ -53,9 +99,14 @@ class HTPController(object):
         parser_thread.daemon = True
         parser_thread.start()
 
+    @property
+    def alive(self):
+        """ Returns False once the engine closed its output pipe. """
+        return not self.eof_event.is_set()
+
     def command_clearboard(self):
-        """ Tell the engine to clear the board. """
-        self.send_command("clearboard")
+        """ Tell the engine to clear the board. Replies still expected from the last game are dropped. """
+        return self.send_command("clearboard\n")
 
     def command_genmove(self, color):
         """
@@ -64,7 +115,16 @@ class HTPController(object):
         """
         if color.upper() not in (RED, BLUE):
             raise ValueError("Invalid color to command genmove.")
-        self.send_command("genmove {}\n".format(color.upper()))
+        return self.send_command("genmove {}\n".format(color.upper()))
+
+    def command_reg_genmove(self, color):
+        """
+        [Command] Tell the engine to decide on a move for given color without playing it. The move will be returned as a
+        coordinates response and stored in self.move_queue.
+        """
+        if color.upper() not in (RED, BLUE):
+            raise ValueError("Invalid color to command reg_genmove.")
+        return self.send_command("reg_genmove {}\n".format(color.upper()))
 
     def command_play(self, color, coordinates):
         """ [Command] Tell the engine to make given move internally. """
@@ -73,55 +133,191 @@ class HTPController(object):
         if not self.valid_htp_coordinates(coordinates):
             raise ValueError("Invalid coordinates to command play: {}".format(coordinates))
 
-        self.send_command("play {} {}\n".format(color, coordinates))
+        return self.send_command("play {} {}\n".format(color, coordinates))
 
     def command_quit(self):
         """ [Command] Tell the engine to quit. """
+        logging.info("Quitting. Dropped {} stale and {} unsolicited responses, {} overflowed.".format(
+            self.dropped_stale, self.dropped_unsolicited, self.overflowed))
         self.send_command("quit\n")
 
     def send_command(self, cmd):
-        """ Send any command given as cmd to _pipe_out, with no validations. Accepts either str or bytes object. """
+        """
+        Send any command given as cmd to _pipe_out, with no validations. Accepts either str or bytes object.
+
+        The command is recorded as waiting for a response, under its own id if it has one or a new one. The new id is only
+        written to the engine with command_ids. genmove, reg_genmove and clearboard start a new generation.
+        :return: the id of the command, or None for empty lines and comments, which get no response.
+        """
         if isinstance(cmd, str):
             cmd = cmd.encode()  # Make sure our command is in bytes
 
+        words = cmd.decode(errors="replace").lower().split()
+        if not words or words[0].startswith("#"):
+            command_id = name = None
+        elif words[0].isdigit():
+            command_id = int(words[0])
+            name = words[1] if len(words) > 1 else None
+        else:
+            command_id = next(self._ids)
+            name = words[0]
+            if self.command_ids:
+                cmd = "{} ".format(command_id).encode() + cmd.lstrip()
+
         logging.info("Sending command: {}".format(repr(cmd)))
-        self._pipe_out.write(cmd)
-        self._pipe_out.flush()
+        with self._send_lock:
+            if command_id is not None:
+                if name in MOVE_COMMANDS or name == "clearboard":
+                    self._new_generation()
+                if len(self._pending) >= MAX_PENDING:
+                    self._pending.popitem(last=False)
+                    self.overflowed += 1
+                self._pending[command_id] = (name, self._generation)
+
+            try:
+                self._pipe_out.write(cmd)
+                self._pipe_out.flush()
+            except (OSError, ValueError) as err:  # Broken pipe, or the pipe was already closed.
+                logging.warning("Sending command {} failed: {}".format(repr(cmd), repr(err)))
+                self.eof_event.set()
+
+        return command_id
+
+    def _new_generation(self):
+        """ Start a new generation, dropping the moves and failures left over from the previous one. """
+        self._generation += 1
+        for queue in (self.move_queue, self.fail_queue):
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    break
+                logging.warning("Dropping stale response: {}".format(repr(item)))
+                self.dropped_stale += 1
 
     def _reader(self):
-        """ Intended to run as a thread, continually calls readline() on pipe_in and places the input in self.responses. """
+        """
+        Intended to run as a thread, continually reads whatever is available on pipe_in, frames it and places the complete
+        responses in self._response_queue.
+
+        An empty read means the engine closed the pipe (died or quit). The reader then sets self.eof_event, tells the parser
+        to stop by queueing None and exits.
+        """
+        read = getattr(self._pipe_in, "read1", self._pipe_in.readline)  # read1 returns as soon as anything is available.
         while True:
-            in_data = self._pipe_in.readline()
-            if in_data:
-                logging.info("[READER] Adding response to Queue: {}".format(repr(in_data)))
-                self._response_queue.put(in_data)
-            time.sleep(0.2)
+            try:
+                in_data = read(READ_SIZE)
+            except (OSError, ValueError) as err:  # ValueError is raised when reading a closed file.
+                logging.warning("[READER] Reading from engine failed: {}".format(repr(err)))
+                in_data = b""
+
+            if not in_data:
+                logging.warning("[READER] Got EOF from engine, stopping.")
+                with self._framer_lock:
+                    response = self._framer.flush()
+                if response is not None:
+                    self._response_queue.put(response)
+                self.eof_event.set()
+                self._response_queue.put(None)
+                with self._send_lock:
+                    self._pending.clear()
+                return
+
+            logging.debug("[READER] Read {} bytes".format(len(in_data)))
+            with self._framer_lock:
+                responses = self._framer.feed(in_data)
+            for response in responses:
+                self._response_queue.put(response)
 
     def _response_parser(self):
-        """ Intented to run as a thread, continually reads from self._response_queue and parses the results. """
+        """
+        Intented to run as a thread, continually reads responses from self._response_queue and parses the results.
+
+        With a frame_timeout, when no response arrives for that long it also completes any response the engine left without an
+        empty line. Without one, such a response is only reported.
+        """
+        timeout = self.frame_timeout if self.frame_timeout is not None else UNTERMINATED_WARNING_DELAY
         while True:
-            response = self._response_queue.get().decode()  # We want to work with unicode strings, not bytes.
-            logging.info("[PARSER] Parsing response: {}".format(repr(response)))
-            response = response.strip().replace("\t", " ")
-
-            response_list = response.split(" ", maxsplit=1)  # An expected response is formatted as =[id] response_data
-            if len(response_list) == 1:
-                logging.debug("Empty response, skipping.")
-                continue
-            else:  # The length of the split can't be more than 2..
-                result, response_data = response_list
-                logging.debug("Result split to {}, {}".format(repr(result), repr(response_data)))
-
-            if result[0] == FAIL_PREFIX:
+            try:
+                response = self._response_queue.get(timeout=timeout)
+            except Empty:
+                with self._framer_lock:
+                    if self.frame_timeout is not None:
+                        response = self._framer.flush(idle=self.frame_timeout)
+                    else:
+                        self._check_unterminated()
+                        response = None
+                if response is None:
+                    continue
+
+            if response is None:  # The reader is done, so are we.
+                return
+            self._handle_response(response)
+
+    def _check_unterminated(self):
+        """ Warn, once, if a response has been left open for UNTERMINATED_WARNING_DELAY seconds. """
+        if not self._warned_unterminated and self._framer.open_for(UNTERMINATED_WARNING_DELAY):
+            logging.warning("[PARSER] The engine didn't end its response with an empty line after {} seconds: {}. Engines that "
+                            "don't send the empty line need a frame_timeout (--lenient).".format(UNTERMINATED_WARNING_DELAY,
+                                                                                                repr(self._framer.peek())))
+            self._warned_unterminated = True
+
+    def _handle_response(self, response):
+        """
+        Match the response with its command. Place failures in self.fail_queue, and moves answering the latest generation's
+        genmove in self.move_queue. Pass every response to the callback.
+        """
+        logging.info("[PARSER] Parsing response: {}".format(repr(response)))
+
+        # The generation check and the put are done under the lock, so a genmove sent meanwhile can't get this reply.
+        with self._send_lock:
+            pending = self._match(response)
+
+            if pending is None:
+                logging.warning("[PARSER] Dropping response to no command: {}".format(repr(response)))
+                self.dropped_unsolicited += 1
+            elif pending[1] != self._generation:
+                if response.status == FAIL_PREFIX or pending[0] in MOVE_COMMANDS:  # Plain acknowledgements need no attention.
+                    logging.warning("[PARSER] Dropping stale response to {}: {}".format(repr(pending[0]), repr(response)))
+                    self.dropped_stale += 1
+            elif response.status == FAIL_PREFIX:
                 logging.info("[PARSER] Adding to failed queue: {}".format(repr(response)))
-                self.fail_queue.put(response)
-            elif result[0] == SUCCESS_PREFIX:
+                self._put_bounded(self.fail_queue, response)
+            elif pending[0] in MOVE_COMMANDS and len(response.lines) == 1:
+                response_data = response.lines[0]
                 logging.debug("[PARSER] Checking if {} is a valid coordinate".format(repr(response_data)))
                 if self.valid_htp_coordinates(response_data):
                     logging.info("[PARSER] Adding to move queue: {}".format(repr(response_data)))
-                    self.move_queue.put(response_data)
-
-            # For the initial naive implementation we will just assume that any success response whose data is valid coordinates is a move.
+                    self._put_bounded(self.move_queue, response_data)
+
+        if self.response_callback is not None:
+            self.response_callback(response)
+
+    def _match(self, response):
+        """ Return (command name, generation) of the command answered by response, or None. Must hold self._send_lock. """
+        if response.id is not None:
+            self._echoes_ids = True
+            # Responses come in order, so commands sent before this one will never be answered.
+            while self._pending and next(iter(self._pending)) < response.id:
+                logging.debug("[PARSER] Command {} was never answered.".format(self._pending.popitem(last=False)))
+            return self._pending.pop(response.id, None)
+
+        if self._echoes_ids or not self._pending:
+            return None
+        return self._pending.popitem(last=False)[1]
+
+    def _put_bounded(self, queue, item):
+        """ Put item in queue, dropping the oldest items if it is full, as nobody is reading them. """
+        while True:
+            try:
+                queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    logging.warning("Queue full, dropping: {}".format(repr(queue.get_nowait())))
+                    self.overflowed += 1
+                except Empty:
+                    pass
 
     @staticmethod
     def valid_htp_coordinates(coordinates):
@@ -147,6 +343,123 @@ class HTPController(object):
             return False
 
 
+class Response(object):
+    """
+    A complete response from the engine.
+
+    status is SUCCESS_PREFIX or FAIL_PREFIX, id is the command id the engine echoed (or None), and lines are the payload lines,
+    the first one being the rest of the status line. The payload is decoded only when lines is first used.
+    """
+
+    __slots__ = ("status", "id", "_data", "_header_end", "_lines")
+
+    def __init__(self, data):
+        """ :param data: bytes of the response, from the status character up to (not including) the empty line. """
+        self._data = data
+        self._lines = None
+        self.status = chr(data[0])
+
+        end = 1
+        while end < len(data) and 48 <= data[end] <= 57:  # The id is the digits right after the status.
+            end += 1
+        self.id = int(data[1:end]) if end > 1 else None
+        self._header_end = end
+
+    @property
+    def success(self):
+        return self.status == SUCCESS_PREFIX
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            text = self._data[self._header_end:].decode(errors="replace").replace("\r", "").replace("\t", " ")
+            lines = text.rstrip("\n").split("\n")
+            lines[0] = lines[0].strip()
+            if len(lines) == 1 and not lines[0]:
+                lines = []
+            self._lines = lines
+        return self._lines
+
+    def __repr__(self):
+        return "<Response {}{} {}>".format(self.status, "" if self.id is None else self.id, repr(self._data[:80]))
+
+
+class ResponseFramer(object):
+    """
+    Splits the byte stream of the engine into Responses.
+
+    Data is appended to a single buffer which is scanned for line ends in place. Only complete responses are copied out of it,
+    and consumed data is dropped from the front of the buffer, so it stays the size of the largest open response.
+
+    A response ends with an empty line. When lenient, a status line also ends the open response, for engines that don't send
+    the empty line.
+    """
+
+    def __init__(self, lenient=False):
+        self.lenient = lenient
+        self._buffer = bytearray()
+        self._scan = 0  # Offset of the first line we haven't looked at.
+        self._start = None  # Offset of the status line of the open response, None if there is none.
+        self._last_feed = time.time()
+
+    def feed(self, data):
+        """ Add data read from the engine, and return a list of the responses it completed. """
+        self._last_feed = time.time()
+        self._buffer += data
+        buffer = self._buffer
+        responses = []
+
+        while True:
+            line_end = buffer.find(b"\n", self._scan)
+            if line_end == -1:
+                break
+            line_start, self._scan = self._scan, line_end + 1
+            blank = line_end == line_start or (line_end == line_start + 1 and buffer[line_start] == 13)  # "\n" or "\r\n"
+
+            if blank:
+                if self._start is not None:
+                    responses.append(Response(bytes(buffer[self._start:line_start])))
+                    self._start = None
+            elif buffer[line_start] in b"=?" and (self._start is None or self.lenient):
+                if self._start is not None:  # The engine didn't end the last response with an empty line.
+                    responses.append(Response(bytes(buffer[self._start:line_start])))
+                self._start = line_start
+            elif self._start is None:
+                logging.debug("[FRAMER] Skipping data outside of a response: {}".format(repr(bytes(buffer[line_start:line_end]))))
+
+        keep = self._scan if self._start is None else self._start
+        if keep:
+            del buffer[:keep]
+            self._scan -= keep
+            if self._start is not None:
+                self._start -= keep
+
+        return responses
+
+    def open_for(self, idle):
+        """ Return True if a response with complete lines is open, and no data was fed for idle seconds. """
+        return self._start is not None and self._scan > self._start and time.time() - self._last_feed >= idle
+
+    def peek(self):
+        """ Return the complete lines of the open response, as bytes. """
+        return bytes(self._buffer[self._start:self._scan]) if self._start is not None else b""
+
+    def flush(self, idle=0):
+        """
+        Return the open response made of the complete lines read so far, or None if there is none.
+
+        :param idle: (default=0) only flush if no data was fed for this many seconds.
+        """
+        if self._start is None or self._scan == self._start or time.time() - self._last_feed < idle:
+            return None
+
+        response = Response(bytes(self._buffer[self._start:self._scan]))
+        del self._buffer[:self._scan]
+        self._scan = 0
+        self._start = None
+        return response
+
+
 if __name__ == "__main__":
     import random
     import itertools
@@ -175,3 +488,75 @@ if __name__ == "__main__":
         got = HTPController.valid_htp_coordinates(value)
         print(value, repr(got), repr(expected))
         assert got == expected
+
+    # Test ResponseFramer
+    framer = ResponseFramer()
+    got = framer.feed(b"= a1\n\n=12 \n a b\n")
+    assert [(r.status, r.id, r.lines) for r in got] == [("=", None, ["a1"])]
+    got = framer.feed(b"\tc d\n\r\nnoise\n?3 illegal move\n")  # Split across reads, CRLF, tabs and a line outside a response.
+    assert [(r.status, r.id, r.lines) for r in got] == [("=", 12, ["", " a b", " c d"])]
+    assert framer.flush(idle=60) is None
+    got = framer.flush()  # No empty line after the failure.
+    assert (got.status, got.id, got.lines, got.success) == ("?", 3, ["illegal move"], False)
+    assert framer.flush() is None
+    got = framer.feed(b"=5 \n  a b c\n= x\n?? y\n\n")  # Payload lines may start with a status character.
+    assert [(r.id, r.lines) for r in got] == [(5, ["", "  a b c", "= x", "?? y"])]
+    assert framer.feed(b"= a1\n= b2\n") == [] and framer.open_for(0) and not framer.open_for(60)
+    assert framer.peek() == b"= a1\n= b2\n" and framer.flush().lines == ["a1", "= b2"]
+
+    framer = ResponseFramer(lenient=True)
+    got = framer.feed(b"=\n=\n= b2\n")  # Lenient engine, responses end when the next one starts.
+    assert [r.lines for r in got] == [[], []] and framer.flush().lines == ["b2"]
+    assert len(framer._buffer) == 0
+    print("ResponseFramer tests passed")
+
+    # Test matching responses with commands, using in-memory pipes as the engine.
+    import io
+    import os
+
+    def wait_for(condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, "Timed out"
+            time.sleep(0.01)
+
+    engine_out, engine_in = os.pipe()
+    sent = io.BytesIO()
+    controller = HTPController(os.fdopen(engine_out, "rb"), sent, command_ids=True)
+
+    first = controller.command_genmove(BLUE)
+    second = controller.command_genmove(BLUE)
+    assert sent.getvalue() == "{} genmove B\n{} genmove B\n".format(first, second).encode()
+    os.write(engine_in, "={} a1\n\n={} b2\n\n".format(first, second).encode())  # The reply to the first genmove came late.
+    assert controller.move_queue.get(timeout=2) == "b2"
+    assert controller.dropped_stale == 1 and controller.move_queue.empty()
+
+    play = controller.command_play(RED, "c3")
+    genmove = controller.command_genmove(BLUE)
+    os.write(engine_in, "={}\n\n=\n\n={} d4\n\n".format(play, genmove).encode())  # An extra "=" line after the play.
+    assert controller.move_queue.get(timeout=2) == "d4"
+    assert controller.dropped_unsolicited == 1
+
+    plays = [controller.command_play(RED, "a1") for _ in range(RESULT_QUEUE_SIZE + 2)]
+    os.write(engine_in, "".join("?{} illegal move\n\n".format(play) for play in plays).encode())  # Nobody reads fail_queue.
+    wait_for(lambda: controller.overflowed == 2)
+    assert controller.fail_queue.qsize() == RESULT_QUEUE_SIZE and controller.fail_queue.get().id == plays[2]
+
+    os.close(engine_in)
+    wait_for(lambda: not controller.alive)
+
+    # Without command_ids, commands are sent as they are and responses are matched in order.
+    engine_out, engine_in = os.pipe()
+    sent = io.BytesIO()
+    controller = HTPController(os.fdopen(engine_out, "rb"), sent)
+    controller.command_genmove(RED)
+    controller.command_genmove(RED)
+    assert sent.getvalue() == b"genmove R\ngenmove R\n"
+    os.write(engine_in, b"= e5\n\n= e6\n\n")
+    assert controller.move_queue.get(timeout=2) == "e6" and controller.dropped_stale == 1
+
+    # A response that is never ended with an empty line is reported.
+    os.write(engine_in, b"= a1\n")
+    wait_for(lambda: controller._warned_unterminated, timeout=UNTERMINATED_WARNING_DELAY * 2)
+    os.close(engine_in)
+    print("Response matching tests passed")
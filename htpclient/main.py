@@ -1,16 +1,23 @@
 """
 The main module of the program. As a main, you are just expected to run it.
 
-As of right now, only supported argument is a command to run the engine process, and it is expected to be encased in quotes.
+The required arguments are a command to run the engine process, which is expected to be encased in quotes, a username and a
+password. Run with --help for the optional arguments.
 Note that this command will run as a shell script with all relevant privilages! Be careful not to use "cd /; rm -rf *" as your engine command!
 """
-import sys
+import argparse
 import os
-import subprocess
 import logging
+import time
 
-from htpclient.htp_controller import HTPController
-from htpclient.web_client import HecksWebClient, ClientError
+from selenium.common.exceptions import TimeoutException
+
+from htpclient.watchdog import EngineWatchdog, EngineError, replay
+from htpclient.htp_controller import LENIENT_FRAME_TIMEOUT
+from htpclient.hedge import HedgedEngine, POLICIES, FIRST, DEFAULT_VOTE_TIMEOUT
+from htpclient.position_cache import PositionCache, CachedEngine, engine_fingerprint
+from htpclient.web_client import HecksWebClient, HecksBrowser, ClientError
+from htpclient.observer import GameObserver, DEFAULT_OUTPUT_DIR
 
 # This part seems to be pythonian necessary evil...
 try:
@@ -26,78 +33,184 @@ RED = "R"
 BLUE = "B"
 
 WAIT_TIMEOUT = 1200  # It's going to take a lot to make us give up...
+START_RETRY_DELAY = 5  # Seconds we wait before searching again after a failed search. Doubled on every failure in a row.
+MAX_START_RETRY_DELAY = 300
 
 
-def main(command, username, password):
+def main(command, username, password, engines=1, policy=FIRST, vote_timeout=DEFAULT_VOTE_TIMEOUT, cache=None, games=0, lenient=False,
+         ids=False):
     """
     The main method of the program.
 
-    Will run the client, open a subprocess with pipe to the given command, and pass them to htp_wrapper.
+    Will run the client, and open the given command as a subprocess under an EngineWatchdog, which keeps a standby copy of the
+    engine ready in case the first one hangs or dies. With more than one engine, genmove is hedged over all of them instead.
 
-    Will manage the required interaction between them.
+    Will manage the required interaction between them. The browser, the login and the engines are kept between games, the engine
+    is only told to clear the board.
 
-    :param run_cmd: the command to run as a subprocess
+    :param command: the command to run as a subprocess
+    :param engines: (default=1) number of engines to run. More than one hedges genmove over all of them.
+    :param policy: (default=FIRST) hedging policy, see htpclient.hedge.
+    :param vote_timeout: time in seconds to wait for votes with the VOTE policy.
+    :param cache: (default=None) path of a position cache file. If given, known positions are answered without the engine.
+    :param games: (default=0) number of games to play. 0 plays until interrupted.
+    :param lenient: (default=False) accept responses that don't end with an empty line.
+    :param ids: (default=False) send commands with GTP ids, for engines that echo them.
     """
+    frame_timeout = LENIENT_FRAME_TIMEOUT if lenient else None
 
-    prc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    controller = HTPController(prc.stdout, prc.stdin)
+    if engines > 1:
+        # The other engines already cover for a failed one, so we skip the standbys.
+        controller = HedgedEngine([EngineWatchdog(command, standby=False, frame_timeout=frame_timeout, command_ids=ids)
+                                   for _ in range(engines)], policy, vote_timeout)
+    else:
+        controller = EngineWatchdog(command, frame_timeout=frame_timeout, command_ids=ids)
 
     web_client = HecksWebClient(username, password)
 
+    if cache:
+        controller = CachedEngine(controller, PositionCache(cache, engine_fingerprint(command)), lambda: web_client.board)
+
     try:
+        session_start = time.time()
         web_client.connect()
         logging.info("Connection successful, starting a game.")
-        engine_color, current_state = web_client.start_game()
-        controller.command_clearboard()
-        if engine_color is None:
-            logging.error('Received color None from web client. Unable to start game.')
-            exit(-1)
-
-        enemey_color = (BLUE if engine_color == RED else RED)
-
-        if current_state:
-            logging.info("Got non-empty state from web_client, sending move commands. {}".format(current_state))
-            color = BLUE
-            for move in current_state:
-                controller.command_play(color, move)
-                color = (BLUE if color == RED else RED)
-
-        while web_client.in_game:
+
+        played = 0
+        idle = 0  # Time spent outside of games: connecting, and searching for the next game.
+        game_end = session_start
+        retry_delay = START_RETRY_DELAY
+        while not games or played < games:
             try:
-                move = web_client.wait_for_move(enemey_color, timeout=WAIT_TIMEOUT)
-                if move:
-                    controller.command_play(enemey_color, move)
-
-                played_succesfully = False
-                while not played_succesfully:
-                    # Ask engine for a move
-                    controller.command_genmove(engine_color)
-
-                    # Block until we get a move
-                    move = controller.move_queue.get()
-                    logging.info("Got move {}, attempting to play it.".format(repr(move)))
-
-                    # Attempt to play it
-                    played_succesfully = web_client.play_move(move, engine_color)
-            except ClientError as err:
-                logging.warning("Got Client error during game loop. Breaking. {}".format(repr(err)))
-                break
+                game_start = play_game(controller, web_client)
+            except (ClientError, TimeoutException) as err:
+                logging.warning("Unable to start a game, searching again in {} seconds. {}".format(retry_delay, repr(err)))
+                time.sleep(retry_delay)
+                retry_delay = min(2 * retry_delay, MAX_START_RETRY_DELAY)
+                continue
+            retry_delay = START_RETRY_DELAY
+
+            waited = game_start - game_end
+            idle += waited
+            game_end = time.time()
+            played += 1
+
+            # Logged as a warning, so it is written with the WARNING level configured above.
+            logging.warning("Game #{} over after {:.0f} seconds, waited {:.0f} seconds for it. Session: {:.0f} seconds idle, "
+                         "{:.1f} games/hour.".format(played, game_end - game_start, waited, idle,
+                                                     played * 3600 / (game_end - session_start)))
     finally:
         controller.command_quit()
         web_client.disconnect()
 
 
-def cli_main():
-    """ Function to be used as CLI entry point. """
+def play_game(controller, web_client):
+    """
+    Start a game with web_client and play it with the engine behind controller until it is over.
+
+    Client, timeout and engine errors end the game but not the session, so the caller can go on to the next game. Errors raised
+    while starting the game are left to the caller, who retries.
 
-    args = sys.argv[1:]
-    if len(args) != 3:
-        print(args)
-        print("Invalid number of arguments.")
-        print("Usage: python main.py \"engine command\" username password")
+    :return: the time the game started at.
+    """
+    engine_color, current_state = web_client.start_game()
+    game_start = time.time()
+    if engine_color is None:
+        logging.error('Received color None from web client. Unable to start game.')
         exit(-1)
 
-    main(*args)
+    enemey_color = (BLUE if engine_color == RED else RED)
+
+    if current_state:
+        logging.info("Got non-empty state from web_client, sending move commands. {}".format(current_state))
+    replay(controller, current_state)
+
+    while web_client.in_game:
+        try:
+            move = web_client.wait_for_move(enemey_color, timeout=WAIT_TIMEOUT)
+            if move:
+                controller.command_play(enemey_color, move)
+
+            played_succesfully = False
+            while not played_succesfully:
+                # Ask engine for a move, and block until we get one. The watchdog replays the kifu to the standby if needed.
+                move = controller.genmove(engine_color, web_client.kifu)
+                logging.info("Got move {}, attempting to play it.".format(repr(move)))
+
+                # Attempt to play it
+                played_succesfully = web_client.play_move(move, engine_color)
+        except ClientError as err:
+            logging.warning("Got Client error during game loop. Breaking. {}".format(repr(err)))
+            break
+        except TimeoutError as err:
+            logging.warning("Opponent took too long to play, leaving the game. {}".format(repr(err)))
+            break
+        except EngineError as err:
+            logging.error("Engine failed during game loop, leaving the game. {}".format(repr(err)))
+            break
+
+    return game_start
+
+
+def observe(command, username, password, game_ids, engines=1, output=DEFAULT_OUTPUT_DIR, lenient=False, ids=False):
+    """
+    Observe the given games until they are over, and write the analysis of a pool of engines to the output directory.
+
+    :param command: the command to run the analysis engines as subprocesses
+    :param game_ids: ids of the games to observe
+    :param engines: (default=1) number of engines in the analysis pool
+    :param output: (default=DEFAULT_OUTPUT_DIR) directory to write the analysis to, one file per game
+    :param lenient: (default=False) accept responses that don't end with an empty line.
+    :param ids: (default=False) send commands with GTP ids, for engines that echo them.
+    """
+    frame_timeout = LENIENT_FRAME_TIMEOUT if lenient else None
+    pool = [EngineWatchdog(command, standby=False, frame_timeout=frame_timeout, command_ids=ids) for _ in range(engines)]
+    observer = GameObserver(HecksBrowser(username, password), pool, output)
+
+    try:
+        observer.connect()
+        for game_id in game_ids:
+            observer.observe(game_id)
+        observer.run()
+    finally:
+        for engine in pool:
+            engine.command_quit()
+        observer.browser.disconnect()
+
+
+def cli_main():
+    """ Function to be used as CLI entry point. """
+
+    parser = argparse.ArgumentParser(description="Make a Hecks engine using the HTP protocol play on the hecks.space website")
+    parser.add_argument("command", help="command to run the engine, encased in quotes")
+    parser.add_argument("username")
+    parser.add_argument("password")
+    parser.add_argument("--engines", type=int, default=1,
+                        help="number of engines to hedge genmove over, or to analyse with when observing (default: 1)")
+    parser.add_argument("--policy", choices=POLICIES, default=FIRST,
+                        help="take the first answer, or the majority vote (default: {})".format(FIRST))
+    parser.add_argument("--vote-timeout", type=float, default=DEFAULT_VOTE_TIMEOUT,
+                        help="seconds to wait for votes (default: {})".format(DEFAULT_VOTE_TIMEOUT))
+    parser.add_argument("--cache", metavar="PATH", help="file to cache engine replies in, shared across games and runs")
+    parser.add_argument("--games", type=int, default=0, help="number of games to play, 0 to play until interrupted (default: 0)")
+    parser.add_argument("--observe", nargs="+", metavar="GAME_ID", help="observe and analyse these games instead of playing")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR,
+                        help="directory to write the analysis of observed games to (default: {})".format(DEFAULT_OUTPUT_DIR))
+    parser.add_argument("--lenient", action="store_true",
+                        help="for engines that don't end their responses with an empty line (breaks slow multi-line output)")
+    parser.add_argument("--ids", action="store_true", help="send commands with GTP ids, for engines that accept and echo them")
+    args = parser.parse_args()
+
+    if args.engines < 1:
+        parser.error("--engines must be at least 1")
+    if args.games < 0:
+        parser.error("--games can't be negative")
+
+    if args.observe:
+        observe(args.command, args.username, args.password, args.observe, args.engines, args.output, args.lenient, args.ids)
+    else:
+        main(args.command, args.username, args.password, args.engines, args.policy, args.vote_timeout, args.cache, args.games,
+             args.lenient, args.ids)
 
 
 if __name__ == "__main__":
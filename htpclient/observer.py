@@ -0,0 +1,332 @@
+"""
+The observer follows many live games at once and has a pool of engines analyse every new move.
+
+All watched games are opened from one hub tab with window.open, so the hub can read their state directly (they share the
+hecks.space origin). A script in the hub scans the games inside the browser and collects their new moves, and the observer
+drains them with a single execute_script per poll. Polling takes one round trip no matter how many games are watched, and only
+the new moves are sent back.
+
+Each game sticks to one engine of the pool. As long as the engine holds that game it is only sent the new moves, it is replayed
+the whole kifu only when it switches games. For every position the engine is asked what it would play with reg_genmove, and the
+answers are written to one file per game in the output directory, as JSON lines.
+"""
+import threading
+import logging
+import json
+import time
+import os
+
+from selenium.common.exceptions import WebDriverException
+
+from htpclient.htp_controller import RED, BLUE, RESIGN
+from htpclient.watchdog import EngineError, EngineWorker, replay
+from htpclient.web_client import HecksWebClient, HECKS_URL
+
+logging = logging.getLogger(__name__)
+
+DEFAULT_OBSERVE_DELAY = 1  # Seconds between two polls of the hub.
+DEFAULT_OUTPUT_DIR = "analysis"
+
+OBSERVER_JS = """ // Installs window.htpObserver in the hub tab
+window.htpObserver = {
+    games: {},
+    changes: [],
+    watch: function(id, url) {
+        if (!this.games[id]) {
+            this.games[id] = {window: window.open(url, "_blank"), seen: 0, result: null};
+        }
+    },
+    reset: function(id) {
+        var game = this.games[id];
+        if (game) {
+            game.seen = 0;
+            game.result = null;
+        }
+    },
+    unwatch: function(id) {
+        var game = this.games[id];
+        if (game) {
+            game.window.close();
+            delete this.games[id];
+        }
+    },
+    scan: function() {
+        for (var id in this.games) {
+            var game = this.games[id];
+            try {
+                var state = game.window.Blaze.getView(game.window.document.getElementById("canvas1")).templateInstance();
+                var kifu = state.kifu || [];
+                var result = (state.game && state.game.result) || null;
+            } catch (e) {
+                continue;  // The game page is still loading.
+            }
+            if (kifu.length > game.seen || (result && !game.result)) {
+                this.changes.push({gameId: id, start: game.seen, moves: kifu.slice(game.seen), result: result});
+                game.seen = kifu.length;
+                game.result = result;
+            }
+        }
+    },
+    drain: function() {
+        this.scan();
+        var changes = this.changes;
+        this.changes = [];
+        return changes;
+    }
+};
+"""
+WATCH_JS = 'window.htpObserver.watch("{game_id}", "{url}")'
+UNWATCH_JS = 'window.htpObserver.unwatch("{game_id}")'
+RESET_JS = 'window.htpObserver.reset("{game_id}")'
+DRAIN_JS = 'return window.htpObserver.drain()'
+
+
+class GameObserver(object):
+    """
+    Follows games by id and dispatches their new moves to a pool of analysis engines.
+
+    Call connect, observe the games, then run, which blocks until all observed games are over.
+    """
+
+    def __init__(self, browser, engines, output_dir=DEFAULT_OUTPUT_DIR, poll_delay=DEFAULT_OBSERVE_DELAY):
+        """
+        :param browser: HecksBrowser to open the games in.
+        :param engines: list of EngineWatchdog objects to analyse with.
+        :param output_dir: (default=DEFAULT_OUTPUT_DIR) directory to write the analysis to.
+        :param poll_delay: (default=DEFAULT_OBSERVE_DELAY) time in seconds between two polls.
+        """
+        if not engines:
+            raise ValueError("GameObserver needs at least one engine.")
+
+        self.browser = browser
+        self.output_dir = output_dir
+        self.poll_delay = poll_delay
+
+        self.games = {}  # Game id to the HTP moves seen so far.
+        self._assignment = {}  # Game id to the analyst following it.
+        self._analysts = [_Analyst(engine, idx, output_dir) for idx, engine in enumerate(engines)]
+
+        self._handle = None  # Window handle of the hub tab
+        self._stop_event = threading.Event()
+
+    def connect(self):
+        """ Connect the browser if it isn't already, and set up the hub tab. """
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        self.browser.connect()
+        self._handle = self.browser.open_tab()
+        with self.browser.tab(self._handle) as driver:
+            driver.get(HECKS_URL)
+            driver.execute_script(OBSERVER_JS)
+
+    def observe(self, game_id):
+        """ Start following the game with given id. """
+        if game_id in self.games:
+            return
+
+        analyst = min(self._analysts, key=lambda a: a.load)
+        analyst.load += 1
+        self._assignment[game_id] = analyst
+        self.games[game_id] = []
+
+        logging.info("Observing game {} with engine #{}".format(repr(game_id), analyst.idx))
+        with self.browser.tab(self._handle) as driver:
+            driver.execute_script(WATCH_JS.format(game_id=game_id, url=HECKS_URL + "/game/{}".format(game_id)))
+
+    def unobserve(self, game_id):
+        """ Stop following the game with given id and close its tab. """
+        if game_id not in self.games:
+            return
+
+        del self.games[game_id]
+        self._assignment.pop(game_id).load -= 1
+
+        logging.info("No longer observing game {}".format(repr(game_id)))
+        with self.browser.tab(self._handle) as driver:
+            driver.execute_script(UNWATCH_JS.format(game_id=game_id))
+
+    def run(self):
+        """
+        Poll the hub and dispatch the new moves, until all observed games are over or stop is called.
+
+        Returns once the engines are done with every queued position, so no analysis is lost when the caller quits them.
+        """
+        while self.games and not self._stop_event.is_set():
+            try:
+                with self.browser.tab(self._handle) as driver:
+                    changes = driver.execute_script(DRAIN_JS)
+            except WebDriverException as err:
+                logging.warning("Polling observed games failed: {}".format(repr(err)))
+                changes = None
+
+            for change in changes or []:
+                self._on_change(change)
+
+            time.sleep(self.poll_delay)
+
+        logging.info("Waiting for the analysis of the remaining positions.")
+        for analyst in self._analysts:
+            analyst.join()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _on_change(self, change):
+        """ Record the new moves of a game, and queue the analysis of every new position. """
+        game_id = change["gameId"]
+        if game_id not in self.games:
+            return
+
+        kifu = self.games[game_id]
+        analyst = self._assignment[game_id]
+
+        if change["start"] != len(kifu):
+            # Moves were missed or sent twice, so we can't trust what we have. The hub sends the whole game again on the next poll.
+            logging.warning("Game {} has {} moves, but the hub sent moves from {}. Reloading the game.".format(
+                repr(game_id), len(kifu), change["start"]))
+            del kifu[:]
+            analyst.put(analyst.reset, game_id)
+            with self.browser.tab(self._handle) as driver:
+                driver.execute_script(RESET_JS.format(game_id=game_id))
+            return
+
+        for server_move in change["moves"]:
+            move = HecksWebClient.parse_server_coordinates(server_move)
+            if move is None:
+                logging.error("Unable to parse move {} of game {}, no longer observing it.".format(repr(server_move), repr(game_id)))
+                self.unobserve(game_id)
+                return
+
+            kifu.append(move)
+            if move != RESIGN:
+                analyst.put(analyst.analyse, game_id, list(kifu))
+
+        if change["result"]:
+            logging.info("Game {} is over: {}".format(repr(game_id), repr(change["result"])))
+            analyst.put(analyst.finish, game_id, change["result"])
+            self.unobserve(game_id)
+
+
+class _Analyst(EngineWorker):
+    """ One engine of the analysis pool, and the worker thread that sends it its commands in order. """
+
+    def __init__(self, engine, idx, output_dir):
+        super().__init__(engine, idx, "analyst-{}".format(idx))
+        self.output_dir = output_dir
+        self.load = 0  # Number of games assigned to us.
+
+        self._game_id = None  # The game currently on the engine's board.
+        self._synced = 0  # Number of moves of that game played on the engine's board.
+
+    def analyse(self, game_id, kifu):
+        """ Bring the engine to the position after kifu, ask it what it would play next and write it down. """
+        if game_id != self._game_id or self._synced > len(kifu):
+            self._game_id = game_id
+            self._synced = 0
+
+        replay(self.engine, kifu, self._synced)
+        self._synced = len(kifu)
+
+        to_move = BLUE if len(kifu) % 2 == 0 else RED
+        try:
+            suggestion = self.engine.reg_genmove(to_move, kifu)
+        except EngineError as err:
+            logging.error("Engine #{} failed to analyse game {}: {}".format(self.idx, repr(game_id), repr(err)))
+            self._game_id = None  # Start over with the next position.
+            return
+
+        self._write(game_id, {"move_number": len(kifu), "move": kifu[-1], "to_move": to_move, "suggestion": suggestion})
+
+    def finish(self, game_id, result):
+        self._write(game_id, {"result": result})
+        self.reset(game_id)
+
+    def reset(self, game_id):
+        """ Forget what the engine has of the game, so its next position is replayed from the start. """
+        if self._game_id == game_id:
+            self._game_id = None
+
+    def _write(self, game_id, record):
+        record["time"] = time.time()
+        with open(os.path.join(self.output_dir, "{}.jsonl".format(game_id)), "at") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def _failed(self, function, err):
+        super()._failed(function, err)
+        self._game_id = None
+
+
+if __name__ == "__main__":
+    from contextlib import contextmanager
+    import tempfile
+
+    class StubDriver(object):
+        """ Plays the hub: every drain returns the next batch of changes. """
+
+        def __init__(self, batches):
+            self.batches = batches
+            self.scripts = []
+
+        def get(self, url):
+            pass
+
+        def execute_script(self, script):
+            self.scripts.append(script)
+            if script == DRAIN_JS:
+                return self.batches.pop(0) if self.batches else []
+
+    class StubBrowser(object):
+        def __init__(self, driver):
+            self.driver = driver
+
+        def connect(self):
+            pass
+
+        def open_tab(self):
+            return "hub"
+
+        @contextmanager
+        def tab(self, handle):
+            yield self.driver
+
+    class StubEngine(object):
+        def __init__(self):
+            self.calls = []
+
+        def command_clearboard(self):
+            self.calls.append(("clearboard",))
+
+        def command_play(self, color, coordinates):
+            self.calls.append(("play", color, coordinates))
+
+        def reg_genmove(self, color, kifu=()):
+            self.calls.append(("reg_genmove", color))
+            return "c3"
+
+    moves = ["4i", "5j", "6i"]
+    htp_moves = [HecksWebClient.parse_server_coordinates(move) for move in moves]
+    assert None not in htp_moves
+
+    driver = StubDriver([[{"gameId": "g1", "start": 0, "moves": moves[:2], "result": None}],
+                         [{"gameId": "g1", "start": 5, "moves": moves[2:], "result": None}],  # Moves were missed.
+                         [{"gameId": "g1", "start": 0, "moves": moves, "result": "B+R"}]])
+    engine = StubEngine()
+    output_dir = tempfile.mkdtemp()
+    observer = GameObserver(StubBrowser(driver), [engine], output_dir, poll_delay=0)
+    observer.connect()
+    observer.observe("g1")
+    observer.run()  # Returns once the game is over and its positions are analysed.
+
+    assert RESET_JS.format(game_id="g1") in driver.scripts and not observer.games
+    assert engine.calls == [("clearboard",), ("play", BLUE, htp_moves[0]), ("reg_genmove", RED),
+                            ("play", RED, htp_moves[1]), ("reg_genmove", BLUE),
+                            # After the reset, the game is replayed from the start.
+                            ("clearboard",), ("play", BLUE, htp_moves[0]), ("reg_genmove", RED),
+                            ("play", RED, htp_moves[1]), ("reg_genmove", BLUE),
+                            ("play", BLUE, htp_moves[2]), ("reg_genmove", RED)]
+
+    with open(os.path.join(output_dir, "g1.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    assert [record.get("move_number") for record in records] == [1, 2, 1, 2, 3, None]
+    assert records[-1]["result"] == "B+R" and all(record.get("suggestion", "c3") == "c3" for record in records)
+    print("GameObserver tests passed")
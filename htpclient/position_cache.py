@@ -0,0 +1,289 @@
+"""
+A persistent cache of engine replies, keyed by position.
+
+Positions are hashed with Zobrist hashing: every (point, value) pair of the board gets a fixed 64 bit key, and the hash of a
+position is the xor of the keys of all occupied points. The board is the one the server shows (dotsData), not the moves played,
+so the same position reached through a different move order gets the same hash, and stones that were captured no longer count.
+
+Replies are kept in an in-memory LRU in front of a shelve file, so they survive restarts. The file remembers a fingerprint of the
+engine it was filled by, and is emptied when the fingerprint changes.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import logging
+import shelve
+import shlex
+import shutil
+import os
+
+from htpclient.htp_controller import RED, BLUE, RESIGN
+from htpclient.watchdog import replay
+
+logging = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_SIZE = 10000  # Positions kept in memory.
+ENGINE_KEY = "__engine__"  # Shelf key holding the fingerprint of the engine the cache was filled by.
+
+
+@lru_cache(maxsize=None)
+def zobrist_key(y, x, value):
+    """ Return the 64 bit key of the point at row y, column x holding value. Derived from a digest, so it is the same across runs. """
+    digest = hashlib.sha1("{}:{}:{}".format(y, x, value).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def position_hash(board):
+    """
+    Return the Zobrist hash of a board.
+
+    :param board: rows of point values as sent by the server (dotsData), 0 for an empty point.
+    """
+    h = 0
+    for y, row in enumerate(board):
+        for x, value in enumerate(row):
+            if value:
+                h ^= zobrist_key(y, x, value)
+    return h
+
+
+def engine_fingerprint(command):
+    """
+    Return a string identifying the engine build run by command.
+
+    It covers the command itself, and the size and modification time of every file named in it, so rebuilding the engine
+    binary (or editing an engine script) changes the fingerprint. The program is also looked up in PATH, as most commands
+    name it without a path.
+    """
+    fingerprint = hashlib.sha1(command.encode())
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        words = command.split()
+
+    if words and not os.path.isfile(words[0]):
+        program = shutil.which(words[0])
+        if program:
+            words[0] = program
+
+    for word in words:
+        if os.path.isfile(word):
+            stat = os.stat(word)
+            fingerprint.update("{}:{}:{}".format(os.path.abspath(word), stat.st_size, stat.st_mtime).encode())
+    return fingerprint.hexdigest()
+
+
+class PositionCache(object):
+    """ Maps (position, color) to the move the engine replied with. """
+
+    def __init__(self, path, engine_id, memory_size=DEFAULT_MEMORY_SIZE):
+        """
+        Open (or create) the cache file at path. If it was filled by a different engine, it is emptied.
+
+        :param path: path of the shelve file.
+        :param engine_id: fingerprint of the engine, see engine_fingerprint.
+        :param memory_size: (default=DEFAULT_MEMORY_SIZE) number of positions kept in memory.
+        """
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._shelf = shelve.open(path)
+
+        if self._shelf.get(ENGINE_KEY) != engine_id:
+            logging.info("Position cache at {} is new or was filled by another engine, clearing it.".format(repr(path)))
+            self._shelf.clear()
+            self._shelf[ENGINE_KEY] = engine_id
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, board, color):
+        """ Return the cached move for color on board, or None. """
+        key = self._key(board, color)
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            move = self._memory[key]
+        else:
+            move = self._shelf.get(key)
+            if move is not None:
+                self._remember(key, move)
+
+        if move is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return move
+
+    def put(self, board, color, move):
+        """ Store move as the reply for color on board. """
+        key = self._key(board, color)
+        self._remember(key, move)
+        self._shelf[key] = move
+
+    def discard(self, board, color):
+        """ Forget the reply for color on board. """
+        key = self._key(board, color)
+        self._memory.pop(key, None)
+        if key in self._shelf:
+            del self._shelf[key]
+
+    def close(self):
+        logging.warning("Position cache: {} hits, {} misses, hit ratio {:.2%}".format(self.hits, self.misses, self.hit_ratio))
+        self._shelf.close()
+
+    def _remember(self, key, move):
+        self._memory[key] = move
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    @staticmethod
+    def _key(board, color):
+        return "{}:{:016x}".format(color.upper(), position_hash(board))
+
+
+class CachedEngine(object):
+    """
+    Exposes the same commands as EngineWatchdog, answering genmove from a PositionCache when possible.
+
+    On a hit the engine is only told to play the cached move, so it stays in sync with the game.
+    """
+
+    def __init__(self, engine, cache, board_source):
+        """
+        :param engine: EngineWatchdog or HedgedEngine to ask on a miss.
+        :param cache: PositionCache to use.
+        :param board_source: function returning the current board (see position_hash), or None if it is unknown.
+        """
+        self.engine = engine
+        self.cache = cache
+        self.board_source = board_source
+        self._last_request = None  # (kifu, color) of the last genmove we answered.
+
+    def command_clearboard(self):
+        self._last_request = None
+        self.engine.command_clearboard()
+
+    def command_play(self, color, coordinates):
+        self._last_request = None
+        self.engine.command_play(color, coordinates)
+
+    def command_quit(self):
+        """ Tell the engine to quit, and close the cache. """
+        self.engine.command_quit()
+        self.cache.close()
+
+    def genmove(self, color, kifu=()):
+        """
+        Return the cached move for the position, or ask the engine and cache its reply.
+
+        Asking again for the same position right after an answer means the move could not be played, so it is dropped from
+        the cache, the engine (which played it) is brought back to the position by replaying the kifu, and asked instead.
+        """
+        kifu = list(kifu)
+        request = (kifu, color)
+        board = self.board_source()  # Taken before the move is played, the reply is for this board.
+
+        if request == self._last_request:
+            logging.warning("Move for {} was not played, dropping it from the cache and asking the engine.".format(repr(color)))
+            if board is not None:
+                self.cache.discard(board, color)
+            replay(self.engine, kifu)
+            move = None
+        elif board is not None:
+            move = self.cache.get(board, color)
+        else:
+            move = None
+
+        if move is not None:
+            logging.info("Position cache hit for {}: {}".format(repr(color), repr(move)))
+            self.engine.command_play(color, move)
+        else:
+            move = self.engine.genmove(color, kifu)
+            if board is not None and move != RESIGN:  # Resigning depends on more than the position, so we always ask.
+                self.cache.put(board, color, move)
+
+        self._last_request = request
+        return move
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Test position_hash
+    empty = [[0] * 11 for _ in range(4)]
+    assert position_hash([]) == position_hash(empty) == 0
+
+    board = [row[:] for row in empty]
+    board[0][1], board[2][3] = 1, 2
+    transposed = [row[:] for row in empty]
+    transposed[2][3], transposed[0][1] = 2, 1
+    assert position_hash(board) == position_hash(transposed) != 0  # Same stones, whatever the order they came in
+    swapped = [row[:] for row in empty]
+    swapped[0][1], swapped[2][3] = 2, 1
+    assert position_hash(board) != position_hash(swapped)  # Same points, other colors
+
+    captured = [row[:] for row in board]
+    captured[0][1] = 0
+    alone = [row[:] for row in empty]
+    alone[2][3] = 2
+    assert position_hash(captured) == position_hash(alone) == zobrist_key(2, 3, 2)  # A captured stone leaves no trace
+    print("position_hash tests passed")
+
+    # Test engine_fingerprint
+    bin_dir = tempfile.mkdtemp()
+    program = os.path.join(bin_dir, "htp-test-engine")
+    with open(program, "wt") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(program, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    before = engine_fingerprint("htp-test-engine --htp")
+    with open(program, "at") as f:
+        f.write("# Rebuilt\n")
+    assert engine_fingerprint("htp-test-engine --htp") != before  # Found through PATH
+    assert engine_fingerprint("htp-test-engine --htp") == engine_fingerprint("htp-test-engine --htp")
+    print("engine_fingerprint tests passed")
+
+    # Test CachedEngine
+    class StubEngine(object):
+        def __init__(self):
+            self.calls = []
+
+        def command_clearboard(self):
+            self.calls.append(("clearboard",))
+
+        def command_play(self, color, coordinates):
+            self.calls.append(("play", color, coordinates))
+
+        def command_quit(self):
+            pass
+
+        def genmove(self, color, kifu=()):
+            self.calls.append(("genmove", color))
+            return "c3"
+
+    stub = StubEngine()
+    current = {"board": board}
+    engine = CachedEngine(stub, PositionCache(os.path.join(tempfile.mkdtemp(), "cache"), "stub"), lambda: current["board"])
+
+    assert engine.genmove(BLUE, ["a1", "b2"]) == "c3" and stub.calls == [("genmove", BLUE)]  # Miss
+    engine.command_clearboard()
+    stub.calls = []
+    assert engine.genmove(BLUE, ["b2", "a1"]) == "c3" and stub.calls == [("play", BLUE, "c3")]  # Hit, even with another move order
+
+    stub.calls = []
+    assert engine.genmove(BLUE, ["b2", "a1"]) == "c3"  # The hit was not played: resync and ask the engine.
+    assert stub.calls == [("clearboard",), ("play", BLUE, "b2"), ("play", RED, "a1"), ("genmove", BLUE)]
+
+    current["board"] = None  # No board, no cache.
+    engine.command_clearboard()
+    stub.calls = []
+    assert engine.genmove(BLUE, ["b2", "a1"]) == "c3" and stub.calls == [("genmove", BLUE)]
+    assert engine.cache.hits == 1 and engine.cache.misses == 1
+    engine.command_quit()
+    print("CachedEngine tests passed")
@@ -2,7 +2,11 @@
 This "engine" decides on the next move, when prompted with the "genmove" command,
 by reading it from a file (given as first CLI arguments) and is used for testing purposes.
 
-For any other command the "engine" will respond with success (=\n)
+For any other command the "engine" will respond with success (=\n). Every response ends with an empty line, and echoes the
+command id if there is one, as in GTP.
+
+Two lines of the file have a special meaning: "= last" answers with the last move the engine was told to play, which shows
+what the engine has on its board, and "hang" never answers.
 """
 import sys
 import logging
@@ -16,21 +20,35 @@ if __name__ == "__main__":
     with open(a, "rt") as f:
         logging.debug("Reading from file: {}".format(a))
         has_data = True
+        last_played = ""
 
         while has_data:
             in_data = input()
             logging.debug("got: " + in_data)
 
+            words = in_data.split()
+            command_id = words[0] if words and words[0].isdigit() else ""
+            if command_id:
+                words = words[1:]
+
             if "genmove" in in_data:
-                out = f.readline()
+                out = f.readline().strip()
                 logging.debug("Sending: {}".format(out))
                 if not out:
-                    print("? out of data\n")
+                    print("?{} out of data\n".format(command_id))
                     has_data = False
-                print(out.strip())
+                elif out == "hang":
+                    continue
+                elif out == "= last":
+                    print("={} {}\n".format(command_id, last_played))
+                else:
+                    print(out[0] + command_id + out[1:] + "\n")
             elif "quit" in in_data:
+                print("={}\n".format(command_id))
                 exit(0)
             else:
-                print("=")
+                if len(words) == 3 and words[0] == "play":
+                    last_played = words[2]
+                print("={}\n".format(command_id))
 
-        sys.stdout.flush()
+            sys.stdout.flush()
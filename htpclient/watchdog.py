@@ -0,0 +1,355 @@
+"""
+The watchdog keeps an engine answering genmove requests. It runs the engine command twice: an active engine which gets all the
+commands, and a hot standby which is started in advance and kept idle.
+
+If the active engine dies, closes its pipe, or takes longer than the hang timeout to answer, it is killed and the standby is
+promoted, brought to the current position by replaying the kifu, and the genmove is sent again. A fresh standby is then started
+in the background. The genmove timeout covers the whole genmove, so the standby only gets the time the failed engine left over.
+A failed engine is always replaced, even when no time is left to ask the standby, so it is never reused for the next genmove.
+
+Engines are started in their own process group, and the whole group is killed, so an engine run by a compound shell command
+doesn't outlive its shell.
+
+An engine that answers the genmove with an error is not failed over: the standby would get the same position and give the same
+answer, so EngineError is raised right away.
+"""
+from queue import Queue, Empty
+from threading import Thread, Lock
+import subprocess
+import logging
+import signal
+import time
+import os
+
+from htpclient.htp_controller import HTPController, RED, BLUE
+
+logging = logging.getLogger(__name__)
+
+DEFAULT_GENMOVE_TIMEOUT = 30  # Seconds we let the engines think before we give up on the genmove.
+HANG_FRACTION = 0.5  # Share of the genmove timeout one engine gets before it is deemed hung and failed over, by default.
+CHECK_INTERVAL = 0.1  # How often we check the engine for signs of life while waiting for a move.
+MAX_FAILOVERS = 2  # Number of standby engines we try for one genmove before giving up.
+KILL_TIMEOUT = 2  # Seconds we give a failed engine to die after killing it.
+
+
+class EngineWatchdog(object):
+    """
+    Runs an engine command with a hot standby, and exposes the engine commands used by main.
+
+    Use EngineWatchdog.genmove instead of HTPController.command_genmove followed by move_queue.get(). genmove always returns
+    a move, or raises EngineError if no engine managed to answer.
+    """
+
+    def __init__(self, command, genmove_timeout=DEFAULT_GENMOVE_TIMEOUT, standby=True, frame_timeout=None, hang_timeout=None,
+                 command_ids=False):
+        """
+        Start the active engine and, if standby is True, the standby engine.
+
+        :param command: shell command that runs the engine.
+        :param genmove_timeout: maximum time in seconds to wait for a genmove response, failovers included.
+        :param standby: (default=True) keep a pre-started engine ready to take over.
+        :param frame_timeout: (default=None) passed to HTPController, for engines that don't end their responses with an empty line.
+        :param hang_timeout: (default=None) time in seconds one engine may think before it is failed over. None for
+                             HANG_FRACTION of genmove_timeout.
+        :param command_ids: (default=False) passed to HTPController, for engines that accept and echo GTP command ids.
+        """
+        self.command = command
+        self.genmove_timeout = genmove_timeout
+        self.hang_timeout = hang_timeout if hang_timeout is not None else genmove_timeout * HANG_FRACTION
+        self.frame_timeout = frame_timeout
+        self.command_ids = command_ids
+        self.failovers = 0
+
+        self._use_standby = standby
+        self._standby = None
+        self._standby_lock = Lock()  # Guards self._standby, which the standby spawner thread sets.
+        self._closed = False
+
+        self._process, self.controller = self._spawn()
+        if standby:
+            self._standby = self._spawn()
+
+    @property
+    def alive(self):
+        """ Returns True if the active engine process is running and its pipe is open. """
+        return self._process.poll() is None and self.controller.alive
+
+    def command_clearboard(self):
+        """ Tell the active engine to clear the board. """
+        self.controller.command_clearboard()
+
+    def command_play(self, color, coordinates):
+        """ Tell the active engine to make given move internally. """
+        self.controller.command_play(color, coordinates)
+
+    def command_quit(self):
+        """ Tell both engines to quit. """
+        self.controller.command_quit()
+        with self._standby_lock:
+            self._closed = True
+            standby, self._standby = self._standby, None
+        if standby:
+            standby[1].command_quit()
+
+    def genmove(self, color, kifu=()):
+        """
+        Ask the engine for a move for color and block until it answers.
+
+        On failure, the standby engine takes over. It is replayed the kifu before being asked for the move again.
+
+        :param color: color to generate a move for.
+        :param kifu: HTP moves played so far in the game, starting with blue.
+        :return: HTP-compliant move.
+        """
+        return self._generate("genmove", color, kifu)
+
+    def reg_genmove(self, color, kifu=()):
+        """ Same as genmove, but the engine doesn't play the move. Used for analysis. """
+        return self._generate("reg_genmove", color, kifu)
+
+    def _generate(self, command, color, kifu):
+        deadline = time.time() + self.genmove_timeout
+        for _ in range(MAX_FAILOVERS + 1):
+            move = self._wait_for_move(command, color, min(deadline, time.time() + self.hang_timeout))
+            if move is not None:
+                return move
+
+            # The engine died or hung. Replace it even if we are out of time, so the next genmove doesn't get it.
+            self._failover(kifu)
+            if time.time() >= deadline:
+                break
+
+        raise EngineError("No engine answered {} {} within {} seconds".format(command, color, self.genmove_timeout))
+
+    def _wait_for_move(self, command, color, deadline):
+        """
+        Send command to the active engine and wait for the answer until deadline.
+
+        Return None if the engine died or ran out of time, and raise EngineError if it answered with an error.
+        """
+        command_id = getattr(self.controller, "command_" + command)(color)
+
+        while True:
+            try:
+                return self.controller.move_queue.get(timeout=CHECK_INTERVAL)
+            except Empty:
+                pass
+
+            while not self.controller.fail_queue.empty():
+                response = self.controller.fail_queue.get_nowait()
+                if response.id is None or response.id == command_id:
+                    raise EngineError("Engine failed to generate a move for {}: {}".format(repr(color), repr(response)))
+
+            if not self.alive:
+                logging.error("Engine died while generating a move for {}.".format(repr(color)))
+                return None
+
+            if time.time() > deadline:
+                logging.error("Engine ran out of time to generate a move for {}.".format(repr(color)))
+                return None
+
+    def _failover(self, kifu):
+        """ Replace the active engine with the standby, and bring it to the position given by kifu. """
+        self.failovers += 1
+        logging.warning("Failing over to standby engine (failover #{}).".format(self.failovers))
+
+        self._kill(self._process)
+
+        with self._standby_lock:
+            standby, self._standby = self._standby, None
+        if standby is not None and standby[0].poll() is None and standby[1].alive:
+            self._process, self.controller = standby
+        else:
+            logging.warning("No live standby engine, starting a new one.")
+            if standby is not None:
+                self._kill(standby[0])
+            self._process, self.controller = self._spawn()
+
+        replay(self.controller, kifu)
+
+        if self._use_standby:
+            standby_thread = Thread(target=self._start_standby, name="standby-spawner")
+            standby_thread.daemon = True
+            standby_thread.start()
+
+    def _start_standby(self):
+        """ Spawn a standby. One that is already there (two failovers in a row) or that comes too late is told to quit. """
+        standby = self._spawn()
+        with self._standby_lock:
+            if self._closed:
+                replaced = standby
+            else:
+                replaced, self._standby = self._standby, standby
+        if replaced is not None:
+            replaced[1].command_quit()
+
+    def _spawn(self):
+        """ Start the engine command in its own process group, and return the process and a controller attached to it. """
+        logging.info("Starting engine: {}".format(repr(self.command)))
+        if os.name == "nt":
+            prc = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            prc = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        return prc, HTPController(prc.stdout, prc.stdin, frame_timeout=self.frame_timeout, command_ids=self.command_ids)
+
+    @staticmethod
+    def _kill(prc):
+        """ Make sure a failed engine is gone, with everything the shell started for it. """
+        try:
+            if os.name == "nt":
+                subprocess.call(["taskkill", "/F", "/T", "/PID", str(prc.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(prc.pid, signal.SIGKILL)
+            prc.wait(timeout=KILL_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as err:
+            logging.warning("Unable to kill engine process {}: {}".format(prc.pid, repr(err)))
+
+
+class EngineWorker(object):
+    """
+    An engine, and the worker thread that sends it its commands in order, so a slow engine never blocks the caller.
+
+    Jobs are functions queued with put. join blocks until all queued jobs are done.
+    """
+
+    def __init__(self, engine, idx, name):
+        """
+        :param engine: EngineWatchdog to send the commands to.
+        :param idx: number of the engine, used in logs.
+        :param name: name of the worker thread.
+        """
+        self.engine = engine
+        self.idx = idx
+
+        self._jobs = Queue()
+
+        worker_thread = Thread(target=self._worker, name=name)
+        worker_thread.daemon = True
+        worker_thread.start()
+
+    def put(self, function, *args):
+        self._jobs.put((function, args))
+
+    def join(self):
+        """ Block until all queued jobs are done. """
+        self._jobs.join()
+
+    def _failed(self, function, err):
+        """ Called from the worker thread when a job raised err. """
+        logging.error("Engine #{} job {} failed: {}".format(self.idx, function.__name__, repr(err)))
+
+    def _worker(self):
+        while True:
+            function, args = self._jobs.get()
+            try:
+                function(*args)
+            except Exception as err:  # One broken engine must not take the worker down with it.
+                self._failed(function, err)
+            finally:
+                self._jobs.task_done()
+
+
+def replay(engine, kifu, start=0):
+    """
+    Bring engine to the position after kifu, by clearing its board and playing the moves.
+
+    :param engine: anything with command_clearboard and command_play, e.g. an EngineWatchdog or an HTPController.
+    :param kifu: HTP moves played so far in the game, starting with blue.
+    :param start: (default=0) number of moves of kifu the engine already has. If given, only the moves after them are played.
+    """
+    if not start:
+        engine.command_clearboard()
+    for idx in range(start, len(kifu)):
+        engine.command_play(BLUE if idx % 2 == 0 else RED, kifu[idx])
+
+
+class EngineError(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    import os
+    import shlex
+    import sys
+    import tempfile
+
+    # The test engine logs to logs/engine.log, so run it from a scratch directory.
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("logs")
+
+    def engine_command(*lines):
+        with open("moves{}.txt".format(len(os.listdir("."))), "wt") as f:
+            f.write("".join(line + "\n" for line in lines))
+        test_engine = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_engine.py")
+        return " ".join(shlex.quote(word) for word in (sys.executable, test_engine, f.name))
+
+    # Failover with kifu replay: the active engine dies, the standby is replayed the kifu and answers with its last move.
+    watchdog = EngineWatchdog(shlex.quote(sys.executable) + " -c pass", genmove_timeout=5, standby=False)
+    watchdog.command = engine_command("= last", "= last")  # Any engine started from now on replays the kifu correctly.
+    watchdog._standby = watchdog._spawn()
+    watchdog.command_play(BLUE, "a1")
+    watchdog.command_play(RED, "b2")
+    assert watchdog.genmove(BLUE, ["a1", "b2"]) == "b2" and watchdog.failovers == 1
+    watchdog.command_play(RED, "c3")
+    assert watchdog.genmove(BLUE, ["a1", "b2", "c3"]) == "c3" and watchdog.failovers == 1
+    watchdog.command_quit()
+
+    # An error reply raises at once, without failing over.
+    watchdog = EngineWatchdog(engine_command("? illegal move"), genmove_timeout=10)
+    start = time.time()
+    try:
+        watchdog.genmove(BLUE)
+        assert False, "genmove should have raised EngineError"
+    except EngineError:
+        pass
+    assert time.time() - start < 1 and watchdog.failovers == 0
+    watchdog.command_quit()
+
+    # A hung engine is failed over after the hang timeout, and the standby answers within what is left of the genmove timeout.
+    watchdog = EngineWatchdog(engine_command("hang"), genmove_timeout=3, hang_timeout=1, standby=False)
+    watchdog.command = engine_command("= d4")
+    watchdog._standby = watchdog._spawn()
+    hung = watchdog._process
+    start = time.time()
+    assert watchdog.genmove(BLUE) == "d4" and watchdog.failovers == 1 and 1 <= time.time() - start < 2
+    assert hung.poll() is not None and watchdog._process is not hung
+    watchdog.command_quit()
+
+    # One deadline for the whole genmove. When it runs out, the hung engine is still replaced before EngineError is raised.
+    watchdog = EngineWatchdog(engine_command("hang"), genmove_timeout=1, hang_timeout=5)
+    hung = watchdog._process
+    start = time.time()
+    try:
+        watchdog.genmove(BLUE)
+        assert False, "genmove should have raised EngineError"
+    except EngineError:
+        pass
+    assert time.time() - start < 1.5 and watchdog.failovers == 1 and hung.poll() is not None
+    watchdog.command_quit()
+
+    # A compound command runs the engine under a shell. Killing the engine must kill what the shell started too.
+    if os.path.isdir("/proc"):
+        watchdog = EngineWatchdog("sleep 60 & echo $! > sleeper.pid; " + engine_command("hang"), standby=False)
+        while not (os.path.exists("sleeper.pid") and os.path.getsize("sleeper.pid")):
+            time.sleep(0.05)
+        with open("sleeper.pid") as f:
+            sleeper = int(f.read())
+        watchdog._kill(watchdog._process)
+        time.sleep(0.1)
+        try:
+            with open("/proc/{}/stat".format(sleeper)) as f:
+                assert f.read().rsplit(")", 1)[1].split()[0] == "Z", "the engine's process group should be gone"
+        except FileNotFoundError:
+            pass
+        watchdog.controller.command_quit()
+
+    # Two failovers in a row: the standby spawned by the first is told to quit when the second one replaces it.
+    watchdog = EngineWatchdog(engine_command("= a1"), standby=False)
+    watchdog._use_standby = True
+    watchdog._start_standby()
+    first = watchdog._standby
+    watchdog._start_standby()
+    assert watchdog._standby is not first and first[0].wait(timeout=2) == 0
+    watchdog.command_quit()
+    print("EngineWatchdog tests passed")
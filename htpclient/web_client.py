@@ -1,11 +1,16 @@
 """
 The web client uses Selenium with Chrome (future: or Firefox) to communicate with the hecks.space website and relay events to the HTP controller,
 which will send pipe them to the engine.
+
+A HecksBrowser holds one logged in Chrome. Every HecksWebClient plays one game in its own tab of a browser, so several games can
+share a single Chrome. A client created without a browser starts its own.
 """
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.common.exceptions import TimeoutException, WebDriverException
 from queue import PriorityQueue
+from contextlib import contextmanager
+import itertools
 import threading
 import logging
 import time
@@ -64,50 +69,214 @@ DEFAULT_PAGE_WAIT_TIMEOUT = 20
 # But should be long enoug for the client to process the move request.
 MOVE_WAIT_TIME = 5
 
+# Time in seconds we wait for automatch to find a game before restarting the search, as the site sometimes stops searching.
+MATCH_SEARCH_TIMEOUT = 300
+
+# Time in seconds after which a game tab queues a new poll even though its last one never came back (e.g. the script failed).
+POLL_RETRY_TIME = 1
+
 POLL_PRIORITY = 10  # Lower number is higher priority
 MOVE_PRIORITY = 3
 QUIT_PRIORITY = 1
 
 
-class HecksWebClient(object):
+class HecksBrowser(object):
     """
-    The class that manages the web client.
+    The class that manages the Chrome instance shared by the game tabs.
 
-    Supports connection and starting a game, and continuesly polls "this.game" JS object for data about the current game state and
-    the turns.
+    Holds the webdriver and the login, and executes scripts for all tabs one by one from a single priority queue, switching to
+    the right window before each script. Scripts of the same priority run in the order they were queued, so tabs polling at the
+    same rate get the same share of the driver.
     """
 
     def __init__(self, username, password):
         """
-        Initialize a new client. Call connect to make is start
+        Initialize a new browser. Call connect to launch it and log in.
 
         :param username: username to connect as
         :param password: password to use for connection
         """
-
-        self.game = None  # Here we will hold the game object updated by self._poll_game
         self.username = username
         self.__password = password
+        self.connected = False
 
         # Oww.. My Eyes... :'(
         if sys.platform in ('win32', 'cygwin'):
             self.chrome_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                                        'selenium_drivers/chromedriver.exe')
-        elif sys.platform == "linux2":
+        elif sys.platform.startswith("linux"):  # "linux2" on Python 2, "linux" on Python 3
             self.chrome_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                                        'selenium_drivers/chromedriver')
         else:
             raise ClientError("Operation system is not currently supported. ")
 
         self._execution_priority_queue = PriorityQueue()
-        self._execution_lock = threading.Lock()
+        self._execution_lock = threading.RLock()  # Reentrant, so browser methods can be called inside a tab() block.
+        self._sequence = itertools.count()  # Tie breaker keeping same-priority scripts in FIFO order.
 
-        self._stop_poll_event = threading.Event()
+        self._current_handle = None  # The window the driver is switched to.
+        self._free_handles = []  # Open windows not used by any client.
 
         executor_thread = threading.Thread(target=self._executor, name="client-executor")
         executor_thread.daemon = True
         executor_thread.start()
 
+    def connect(self):
+        """ Launch Chrome and log in to hecks. Does nothing if already connected. """
+        with self._execution_lock:
+            if self.connected:
+                return
+
+            logging.info("Connecting to Hecks at {}".format(HECKS_URL))
+            chrome_options = webdriver.ChromeOptions()
+            chrome_options.add_argument("--mute-audio")
+            chrome_options.add_argument("--no-logging")
+            self._driver = webdriver.Chrome(self.chrome_path, desired_capabilities=chrome_options.to_capabilities())
+            self._driver.get(HECKS_URL)
+
+            if "login" not in self._driver.current_url:
+                raise ClientError("Unable to reach login page. Are you already logged in?")
+
+            # Find the fields and submit
+            self._driver.find_element_by_id(USERNAME_FIELD_ID).send_keys(self.username)
+            self._driver.find_element_by_id(PASSWORD_FIELD_ID).send_keys(self.__password)
+            self._driver.find_element_by_id(SUBMIT_BUTTON_ID).click()
+
+            WebDriverWait(self._driver, DEFAULT_PAGE_WAIT_TIMEOUT).until(lambda x: "chat" in x.current_url)
+
+            self._current_handle = self._driver.current_window_handle
+            self._free_handles = [self._current_handle]
+            self.connected = True
+
+    def disconnect(self):
+        """ Close Chrome, dropping all queued scripts. """
+        with self._execution_lock:
+            if not self.connected:
+                return
+            self.connected = False
+            self._driver.quit()
+            self._execution_priority_queue = PriorityQueue()
+
+    def open_tab(self):
+        """ Return the handle of a window for a new game, opening a new tab if the login window is already in use. """
+        with self._execution_lock:
+            if self._free_handles:
+                return self._free_handles.pop()
+
+            known_handles = set(self._driver.window_handles)
+            self._driver.execute_script("window.open('about:blank', '_blank');")
+            handle, = set(self._driver.window_handles) - known_handles
+            logging.info("Opened a new tab: {}".format(repr(handle)))
+            return handle
+
+    def close_tab(self, handle):
+        """ Close the tab with the given handle. The last window is kept open and reused, since closing it would quit Chrome. """
+        with self._execution_lock:
+            if not self.connected:
+                return
+            if len(self._driver.window_handles) == 1:
+                self._free_handles.append(handle)
+                return
+            self._switch_to(handle)
+            self._driver.close()
+            self._current_handle = None
+
+    @contextmanager
+    def tab(self, handle):
+        """ Context manager giving exclusive access to the driver, switched to the tab with the given handle. """
+        with self._execution_lock:
+            self._switch_to(handle)
+            yield self._driver
+
+    def wait_until(self, handle, condition, timeout=DEFAULT_PAGE_WAIT_TIMEOUT):
+        """
+        Block until condition(driver) returns a truthy value on the tab with the given handle, and return that value.
+
+        Unlike WebDriverWait, the driver is released between checks so other tabs keep running.
+        Raise TimeoutException if timeout is reached.
+        """
+        w = 0
+        while True:
+            with self.tab(handle) as driver:
+                try:
+                    value = condition(driver)
+                except WebDriverException:
+                    value = None
+            if value:
+                return value
+
+            time.sleep(DEFAULT_POLL_DELAY)
+            w += DEFAULT_POLL_DELAY
+            if w > timeout:
+                raise TimeoutException("wait_until timeout expired")
+
+    def execute(self, handle, priority, script, function=None):
+        """
+        Queue script for execution on the tab with the given handle.
+
+        :param function: (default=None) called with the return value of the script.
+        """
+        self._execution_priority_queue.put((priority, next(self._sequence), handle, script, function))
+
+    def _switch_to(self, handle):
+        if handle != self._current_handle:
+            self._driver.switch_to.window(handle)
+            self._current_handle = handle
+
+    def _executor(self):
+        """
+        Executes scripts one by one from the execution priority queue.
+
+        This method must run in it's own thread.
+
+        The queue is expected to contain tuples for priority, sequence number, window handle, script, callback function. The
+        callback function will be called with the return value of the execution. The last element of the tuple can be None, in
+        which case nothing will be done with the return value.
+
+        Will catch selenium WebDriverExceptions and skip the function if they happen.
+        """
+        while True:
+            priority, _, handle, script, function = self._execution_priority_queue.get()
+            with self._execution_lock:
+                if not self.connected:
+                    continue
+                try:
+                    if priority < POLL_PRIORITY:
+                        logging.debug("[EXECUTOR] Executing script on {}: {}".format(repr(handle), repr(script)))
+                    self._switch_to(handle)
+                    out = self._driver.execute_script(script)
+                    if function is not None:
+                        function(out)
+                except WebDriverException as e:
+                        pass
+
+
+class HecksWebClient(object):
+    """
+    The class that manages the web client.
+
+    Supports connection and starting a game, and continuesly polls "this.game" JS object for data about the current game state and
+    the turns. Each client uses one tab of a HecksBrowser.
+    """
+
+    def __init__(self, username, password, browser=None):
+        """
+        Initialize a new client. Call connect to make is start
+
+        :param username: username to connect as
+        :param password: password to use for connection
+        :param browser: (default=None) HecksBrowser to open the game tab in. If None, the client starts its own browser.
+        """
+
+        self.game = None  # Here we will hold the game object updated by self._poll_game
+        self.username = username
+
+        self._owns_browser = browser is None
+        self.browser = HecksBrowser(username, password) if browser is None else browser
+        self._handle = None  # Window handle of our tab
+
+        self._stop_poll_event = threading.Event()  # Replaced for every poll thread, see _start_polling.
+
     @property
     def color(self):
         """ Returns our color in the game, or None if we are not in a game (or not playing) """
@@ -135,6 +304,20 @@ class HecksWebClient(object):
     def in_game(self):
         return self.game is None or not self.game["game"].get("result", False)
 
+    @property
+    def kifu(self):
+        """ Returns the moves played so far in HTP notation, starting with blue, or an empty list if we are not in a game. """
+        if not self.game:
+            return []
+        return list(map(self.parse_server_coordinates, self.game["kifu"]))
+
+    @property
+    def board(self):
+        """ Returns the server's board (dotsData) as rows of point values, 0 for an empty point, or None if we are not in a game. """
+        if not self.game:
+            return None
+        return [list(row) for row in self.game["dotsData"]]
+
     @property
     def last_move(self):
         if self.game["kifu"]:
@@ -143,37 +326,18 @@ class HecksWebClient(object):
             return None    
 
     def connect(self):
-        """
-        Launch a web page to hecks and attempt to connect to given username and password.
-
-        :param username: username to connect as
-        :param password: password to use for connection
-        """
-
-        logging.info("Connecting to Hecks at {}".format(HECKS_URL))
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument("--mute-audio")
-        chrome_options.add_argument("--no-logging")
-        self._driver = webdriver.Chrome(self.chrome_path, desired_capabilities=chrome_options.to_capabilities())
-        self._driver.get(HECKS_URL)
-
-        if "login" not in self._driver.current_url:
-            raise ClientError("Unable to reach login page. Are you already logged in?")
-
-        # Find the fields and submit
-        self._driver.find_element_by_id(USERNAME_FIELD_ID).send_keys(self.username)
-        self._driver.find_element_by_id(PASSWORD_FIELD_ID).send_keys(self.__password)
-        self._driver.find_element_by_id(SUBMIT_BUTTON_ID).click()
-
-        WebDriverWait(self._driver, DEFAULT_PAGE_WAIT_TIMEOUT).until(lambda x: "chat" in x.current_url)
+        """ Connect the browser to hecks if it isn't already, and take a tab for our game. """
+        self.browser.connect()
+        self._handle = self.browser.open_tab()
 
     def disconnect(self):
-        """ Close the webdriver window and stop the polling session. """
+        """ Stop the polling session and close our tab, or the whole browser if it is ours. """
         self._stop_poll_event.set()
-        self._execution_lock.acquire()
-        self._driver.quit()
-        self._execution_priority_queue = PriorityQueue()
-        self._execution_lock.release()
+        if self._owns_browser:
+            self.browser.disconnect()
+        elif self._handle is not None:
+            self.browser.close_tab(self._handle)
+        self._handle = None
 
     def play_move(self, move, color):
         """
@@ -214,7 +378,7 @@ class HecksWebClient(object):
 
         logging.debug("Sending command for execution: {}".format(repr(js_command)))
 
-        self._execution_priority_queue.put((MOVE_PRIORITY, js_command, None))
+        self.browser.execute(self._handle, MOVE_PRIORITY, js_command)
 
         w = 0
 
@@ -231,44 +395,77 @@ class HecksWebClient(object):
                 logging.warning("Move {} wasn't played! It might be invalid or the server isn't responding.".format(repr(move)))
                 return False
 
-    def start_game(self, id=None):
+    def start_game(self, id=None, search_timeout=MATCH_SEARCH_TIMEOUT):
         """
         Try to start a new game on the web server, and block until it succeeds.
 
         If a game id is passed, the client will attempt to connect to given ID instead of starting a new game.
+        Can be called again once a game is over to start the next one.
         Will return the client's color in the game.
         :param id: ID of game to join. Can be used to reconnect or to observe a game.
+        :param search_timeout: (default=MATCH_SEARCH_TIMEOUT) time in seconds after which automatch is restarted. None to never restart.
         :return: The client's color in the game
         """
+        self.game = None
+
         if id is None:
             logging.info("Starting a new game.")
-            self._driver.get(HECKS_URL + "/play")
-
-            if "play" in self._driver.current_url:
-                try:
-                    WebDriverWait(self._driver, DEFAULT_PAGE_WAIT_TIMEOUT).until(lambda x: x.find_element_by_class_name(MATCH_BUTTON_CLASS))
-                    self._driver.find_element_by_class_name(MATCH_BUTTON_CLASS).click()
-                except TimeoutException:
-                    if "game" in self._driver.current_url:
-                        logging.info("Auto connection to existing game detected.")
-                    else:
-                        raise
-            else:
-                raise ClientError("Unable to reach play page. Are you logged in?")
+            self._search_game()
         else:
             logging.info("Connecting to existing game: {}".format(repr(id)))
-            self._driver.get(HECKS_URL + "/game/{}".format(id))
+            with self.browser.tab(self._handle) as driver:
+                driver.get(HECKS_URL + "/game/{}".format(id))
 
-        self._stop_poll_event.clear()
-        poll_game_thread = threading.Thread(target=self._poll_game, name="game-poll")
-        poll_game_thread.daemon = True
-        poll_game_thread.start()
+        self._start_polling()
 
-        while self.game is None:
+        w = 0
+        # A new search may first land on the game we just finished, so we wait for one that is still on. A game joined by id
+        # is returned as it is, even if it is over.
+        while self.game is None or (id is None and self.game["game"].get("result", False)):
             time.sleep(0.5)
+            w += 0.5
+
+            if id is None and search_timeout and w > search_timeout:
+                w = 0
+                with self.browser.tab(self._handle) as driver:
+                    matched = "/game/" in driver.current_url
+                if not matched:
+                    logging.warning("No game found after {} seconds, restarting the search.".format(search_timeout))
+                    self._search_game()
+                    self._start_polling()  # The page was reloaded, so the filter function has to be injected again.
 
         logging.info("Game started! We are playing as: {}".format(repr(self.color)))
-        return (self.color, list(map(self.parse_server_coordinates, self.game['kifu'])))
+        return (self.color, self.kifu)
+
+    def _search_game(self):
+        """ Open the play page and click automatch. """
+        with self.browser.tab(self._handle) as driver:
+            driver.get(HECKS_URL + "/play")
+            on_play_page = "play" in driver.current_url
+
+        if on_play_page:
+            try:
+                self.browser.wait_until(self._handle, lambda x: x.find_element_by_class_name(MATCH_BUTTON_CLASS))
+                with self.browser.tab(self._handle) as driver:
+                    driver.find_element_by_class_name(MATCH_BUTTON_CLASS).click()
+            except TimeoutException:
+                with self.browser.tab(self._handle) as driver:
+                    in_game_page = "game" in driver.current_url
+                if in_game_page:
+                    logging.info("Auto connection to existing game detected.")
+                else:
+                    raise
+        else:
+            raise ClientError("Unable to reach play page. Are you logged in?")
+
+    def _start_polling(self):
+        """ Stop the current poll thread, if any, and start a new one. """
+        self._stop_poll_event.set()
+        self._stop_poll_event = threading.Event()
+
+        poll_game_thread = threading.Thread(target=self._poll_game, args=(self._stop_poll_event,), name="game-poll")
+        poll_game_thread.daemon = True
+        poll_game_thread.start()
 
     def wait_for_move(self, player, timeout=None):
         """
@@ -293,40 +490,28 @@ class HecksWebClient(object):
 
         return self.parse_server_coordinates(self.last_move)
 
-    def _executor(self):
+    def _poll_game(self, stop_event, poll_delay=DEFAULT_POLL_DELAY):
         """
-        Executes scripts one by one from the execution priority queue.
-
-        This method must run in it's own thread.
-
-        The queue is expected to contain tuples for priority, script, callback function. The callback function will be called with the return value of
-        the execution. The second element of the tuple can be None, in which case nothing will be done with the return value.
+        This thread should be running at all times as long as a game is going, as it updates the game information in the client.
 
-        Will catch selenium WebDriverExceptions and skip the function if they happen.
+        Runs until stop_event is set. Polls still queued by then are ignored, so they can't overwrite the next game.
         """
-        while True:
-            priority, script, function = self._execution_priority_queue.get()
-            self._execution_lock.acquire()
-            try:
-                if priority < POLL_PRIORITY:
-                    logging.debug("[EXECUTOR] Executing script: {}".format(repr(script)))
-                out = self._driver.execute_script(script)
-                if function is not None:
-                    function(out)
-            except WebDriverException as e:
-                    pass
-            finally:
-                self._execution_lock.release()
-
-    def _poll_game(self, poll_delay=DEFAULT_POLL_DELAY):
-        """ This thread should be running at all times as long as a game is going, as it updates the game information in the client. """
+        poll_pending = threading.Event()  # Set while one of our polls is queued, so a slow driver doesn't pile them up.
+        last_poll = 0
+
         def update_game(game):
-            self.game = game
+            poll_pending.clear()
+            if not stop_event.is_set():
+                self.game = game
 
         self.poll_delay = poll_delay
-        self._execution_priority_queue.put((POLL_PRIORITY - 1, FILTER_JS_FUNC, None))
-        while not self._stop_poll_event.is_set():
-            self._execution_priority_queue.put((POLL_PRIORITY, BOARD_INFO_JS.format(properties = REQUIRED_BOARD_PROPERTIES), update_game))
+        self.browser.execute(self._handle, POLL_PRIORITY - 1, FILTER_JS_FUNC)
+        while not stop_event.is_set():
+            # Skip this round if our last poll is still queued behind other tabs.
+            if not poll_pending.is_set() or time.time() - last_poll > POLL_RETRY_TIME:
+                poll_pending.set()
+                last_poll = time.time()
+                self.browser.execute(self._handle, POLL_PRIORITY, BOARD_INFO_JS.format(properties=REQUIRED_BOARD_PROPERTIES), update_game)
             time.sleep(poll_delay)
 
     @staticmethod
@@ -500,3 +685,67 @@ if __name__ == "__main__":
 
     client = HecksWebClient("asfffd", "asffffd")
 
+    # Test HecksBrowser tab scheduling, with a stub driver in place of Chrome.
+    class StubDriver(object):
+        def __init__(self):
+            self.window_handles = ["w0"]
+            self.current_window_handle = "w0"
+            self.executed = []  # (handle, script) in execution order.
+            self.switches = 0
+            self.switch_to = self
+
+        def window(self, handle):
+            assert handle in self.window_handles
+            self.current_window_handle = handle
+            self.switches += 1
+
+        def execute_script(self, script):
+            if script.startswith("window.open"):
+                self.window_handles.append("w{}".format(len(self.window_handles)))
+            else:
+                self.executed.append((self.current_window_handle, script))
+            return script
+
+        def close(self):
+            self.window_handles.remove(self.current_window_handle)
+
+    driver = StubDriver()
+    browser = HecksBrowser("asfffd", "asffffd")
+    with browser._execution_lock:  # What connect does, without Chrome and the login.
+        browser._driver = driver
+        browser._current_handle = driver.current_window_handle
+        browser._free_handles = [browser._current_handle]
+        browser.connected = True
+
+    handles = [browser.open_tab() for _ in range(3)]
+    assert handles == ["w0", "w1", "w2"] and driver.window_handles == handles  # The login window is used first.
+
+    rounds = 3
+    done = threading.Event()
+    results = []
+
+    def collect(out):
+        results.append(out)
+        if len(results) == 3 * rounds + 1:
+            done.set()
+
+    with browser._execution_lock:  # Queue everything before the executor runs any of it.
+        for r in range(rounds):
+            for handle in handles:
+                browser.execute(handle, POLL_PRIORITY, "poll {} {}".format(handle, r), collect)
+        browser.execute("w2", MOVE_PRIORITY, "move", collect)
+    assert done.wait(timeout=5)
+
+    polls = [handle for handle, script in driver.executed if script != "move"]
+    assert polls == handles * rounds  # Same priority: each tab in turn, in the order they were queued.
+    assert [script for handle, script in driver.executed].index("move") <= 1  # Moves jump ahead of the polls.
+    assert all(script == "move" or script.startswith("poll " + handle) for handle, script in driver.executed)
+
+    browser.close_tab("w1")
+    browser.close_tab("w2")
+    browser.close_tab("w0")  # The last window is kept and reused.
+    assert driver.window_handles == ["w0"] and browser._free_handles == ["w0"]
+    assert browser.open_tab() == "w0" and driver.window_handles == ["w0"]
+    assert browser.open_tab() == "w1" and driver.window_handles == ["w0", "w1"]
+    print("HecksBrowser tests passed")
+